@@ -0,0 +1,43 @@
+"""下载失败分类测试：使用 yt-dlp 实际输出的错误信息"""
+import pytest
+
+from yunx_bot import FAILURE_POLICIES, classify_download_error
+
+COOKIES_HINT = (
+    'Use --cookies-from-browser or --cookies for the authentication. See  '
+    'https://github.com/yt-dlp/yt-dlp/wiki/FAQ#how-do-i-pass-cookies-to-yt-dlp  for how to manually pass cookies. '
+    'Also see  https://github.com/yt-dlp/yt-dlp/wiki/Extractors#exporting-youtube-cookies  '
+    'for tips on effectively exporting YouTube cookies'
+)
+
+
+@pytest.mark.parametrize('message, category', [
+    # 单个视频的问题
+    (f"[youtube] dQw4w9WgXcQ: Private video. Sign in if you've been granted access to this video. {COOKIES_HINT}",
+     'removed'),
+    ('[youtube] dQw4w9WgXcQ: Video unavailable. This video has been removed by the uploader', 'removed'),
+    (f'[youtube] dQw4w9WgXcQ: Sign in to confirm your age. This video may be inappropriate for some users. {COOKIES_HINT}',
+     'restricted'),
+    ('[youtube] dQw4w9WgXcQ: Join this channel to get access to members-only content like this video, '
+     'and other exclusive perks.', 'restricted'),
+    ('[youtube] dQw4w9WgXcQ: Requested format is not available. Use --list-formats for a list of available formats',
+     'format_unavailable'),
+    # 平台整体的问题
+    (f"[youtube] dQw4w9WgXcQ: Sign in to confirm you’re not a bot. {COOKIES_HINT}", 'auth'),
+    ('[twitter] 1234567890: This video is only available for registered users. '
+     'Use --cookies-from-browser or --cookies for the authentication.', 'auth'),
+    ('[youtube] dQw4w9WgXcQ: Unable to download API page: HTTP Error 429: Too Many Requests', 'rate_limited'),
+    ('[youtube] dQw4w9WgXcQ: Unable to extract yt initial data; please report this issue on  '
+     'https://github.com/yt-dlp/yt-dlp/issues?q= ', 'extractor'),
+    ('[generic] Unsupported URL: https://example.com/page', 'unsupported'),
+    ('Unable to download webpage: <urlopen error [Errno -3] Temporary failure in name resolution>', 'network'),
+    ('[BiliBili] BV1xx411c7mD: This video may be deleted or geo-restricted. '
+     'You might want to try a VPN or a proxy server (with --proxy)', 'geo_blocked'),
+])
+def test_classify_real_ytdlp_errors(message, category):
+    assert classify_download_error(message) == category
+
+
+@pytest.mark.parametrize('category', ['removed', 'restricted', 'format_unavailable'])
+def test_per_video_failures_do_not_trip_breaker(category):
+    assert not FAILURE_POLICIES[category]['breaker']